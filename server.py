@@ -1,22 +1,87 @@
 import os
-import json
+import re
+import sys
 import time
-from typing import Literal, TypedDict, List, Optional
-
+import asyncio
+import hashlib
+import functools
+import contextlib
+from collections import OrderedDict
+from typing import TYPE_CHECKING, AsyncGenerator, Literal, Dict, List, Optional, Tuple, cast
+
+import msgspec
 from fastmcp import FastMCP
+from fastmcp.exceptions import ToolError
+from fastmcp.tools.tool import ToolResult
+from mcp.types import TextContent
+from pydantic import TypeAdapter
+from typing_extensions import TypedDict  # pydantic needs this on Python < 3.12
 from google import genai
 from google.genai import types as genai_types
 
+if TYPE_CHECKING:
+    import numpy as np
+
 # ---------- Config ----------
 
 GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
+TEMPERATURE = 0.2
+# Models known to accept thinking_budget=0 (thinking off). Others, e.g.
+# gemini-2.5-pro, reject 0, so they keep their default unless a budget is set.
+_THINKING_OFF_MODELS = ("gemini-2.5-flash", "gemini-2.5-flash-lite")
+
+if os.getenv("GEMINI_THINKING_BUDGET"):
+    GEMINI_THINKING_BUDGET: Optional[int] = int(os.environ["GEMINI_THINKING_BUDGET"])
+elif GEMINI_MODEL in _THINKING_OFF_MODELS:
+    GEMINI_THINKING_BUDGET = 0  # a short rewrite doesn't need thinking
+else:
+    GEMINI_THINKING_BUDGET = None  # model default
+
+# On Gemini 2.5 thinking tokens count against max_output_tokens. With a fixed
+# budget the caps are that budget plus room for the few-hundred-token reply;
+# only a reply actually cut off at the cap is retried with more room. When the
+# model decides how much to think (no budget, or -1 for dynamic), keep the
+# original generous cap.
+if GEMINI_THINKING_BUDGET is not None and GEMINI_THINKING_BUDGET >= 0:
+    MAX_OUTPUT_TOKENS = GEMINI_THINKING_BUDGET + 1024
+    MAX_OUTPUT_TOKENS_RETRY = GEMINI_THINKING_BUDGET + 2048
+else:
+    MAX_OUTPUT_TOKENS = 8192
+    MAX_OUTPUT_TOKENS_RETRY = 16384
+
+_THINKING_CONFIG = (
+    genai_types.ThinkingConfig(thinking_budget=GEMINI_THINKING_BUDGET)
+    if GEMINI_THINKING_BUDGET is not None
+    else None
+)
+
+# Identical prompts (same window + comment + hint) are answered from memory
+ENABLE_LLM_CACHE = os.getenv("ENABLE_LLM_CACHE", "1").lower() not in ("0", "false", "no")
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "1024"))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "3600"))  # seconds
+
+# Reworded repeats are answered from the cache too, at the cost of one
+# embedding call per cache miss (off by default)
+ENABLE_SEMANTIC_CACHE = os.getenv("ENABLE_SEMANTIC_CACHE", "0").lower() not in ("0", "false", "no")
+GEMINI_EMBEDDING_MODEL = os.getenv("GEMINI_EMBEDDING_MODEL", "gemini-embedding-001")
+SEMANTIC_CACHE_DIM = 768
+SEMANTIC_CACHE_MAX_DISTANCE = float(os.getenv("SEMANTIC_CACHE_MAX_DISTANCE", "0.05"))  # cosine
+
+
+@functools.lru_cache(maxsize=1)
+def get_client() -> genai.Client:
+    """
+    The shared Gemini client, built on first use and reused afterwards so
+    connections are kept alive across calls. Importing the module never
+    needs the key; a missing key is reported to the MCP client when the
+    tool runs. Failures aren't cached, so a key set later is picked up.
+    """
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        # In FastMCP Cloud this comes from the dashboard env vars
+        raise ToolError("GEMINI_API_KEY is not set on the server, so prompts can't be analyzed.")
+    return genai.Client(api_key=api_key)
 
-api_key = os.getenv("GEMINI_API_KEY")
-if not api_key:
-    # In FastMCP Cloud this comes from the dashboard env vars
-    raise RuntimeError("GEMINI_API_KEY is not set")
-
-client = genai.Client(api_key=api_key)
 
 # Our MCP server instance
 mcp = FastMCP(name="PromptSuggestion")
@@ -36,6 +101,46 @@ class AnalyzeResult(TypedDict):
     confidence: float
 
 
+class AnalyzeRaw(msgspec.Struct):
+    """What we accept from the model. Missing keys fall back to defaults and
+    `alternatives` is not declared, so whatever the model puts there is ignored."""
+    summary: str = ""
+    root_causes: List[str] = []
+    suggested_prompt: str = ""
+    confidence: float = 0.8
+
+
+# AnalyzeResult keys in the order the preamble lists them; the single source
+# for the schema ordering and the system instruction
+RESPONSE_KEYS = list(AnalyzeResult.__annotations__)
+
+# Structured-output schema mirroring AnalyzeResult
+RESPONSE_SCHEMA = genai_types.Schema(
+    type=genai_types.Type.OBJECT,
+    properties={
+        "summary": genai_types.Schema(type=genai_types.Type.STRING),
+        "root_causes": genai_types.Schema(
+            type=genai_types.Type.ARRAY,
+            items=genai_types.Schema(type=genai_types.Type.STRING),
+        ),
+        "suggested_prompt": genai_types.Schema(type=genai_types.Type.STRING),
+        "alternatives": genai_types.Schema(
+            type=genai_types.Type.ARRAY,
+            items=genai_types.Schema(type=genai_types.Type.STRING),
+        ),
+        "confidence": genai_types.Schema(type=genai_types.Type.NUMBER),
+    },
+    required=["summary", "root_causes", "suggested_prompt", "confidence"],
+    property_ordering=RESPONSE_KEYS,
+)
+
+SYSTEM_PROMPT = f"Return ONLY a JSON object with keys: {', '.join(RESPONSE_KEYS)}."
+
+# strict=False lets e.g. "0.9" decode as a float
+_decode_raw = msgspec.json.Decoder(AnalyzeRaw, strict=False).decode
+_encode_json = msgspec.json.Encoder().encode
+
+
 # ---------- Helper: truncate & prompt builder ----------
 
 MAX_MESSAGES = 8  # roughly last 4 turns (user+assistant pairs)
@@ -46,25 +151,35 @@ def truncate_messages(messages: List[ChatMessage]) -> List[ChatMessage]:
     return messages[-MAX_MESSAGES:]
 
 
-def build_user_prompt(
-    messages: List[ChatMessage],
-    user_comment: Optional[str] = None,
-    task_hint: Optional[str] = None,
-) -> str:
-    # Same spirit as your TS version
-    trimmed = truncate_messages(messages)
+# Role labels and the empty-field sentinel, shared instead of rebuilt per call
+_ROLE_UPPER = {r: sys.intern(r.upper()) for r in ("user", "assistant", "system", "tool")}
+_NONE = sys.intern("(none)")
 
-    convo = "\n".join(
-        f"{m['role'].upper()}: {m['content']}"
-        for m in trimmed
-    )
 
-    last_user = next(
-        (m["content"] for m in reversed(trimmed) if m["role"] == "user"),
-        "(unknown last user message)",
-    )
+def render_conversation(messages: List[ChatMessage]) -> Tuple[str, str]:
+    """
+    Render the trimmed window and pick out the last user message, in one
+    pass. Blank messages are dropped and contents are stripped.
+    """
+    last_user = "(unknown last user message)"
+    lines: List[str] = []
+
+    for m in truncate_messages(messages):
+        content = (m.get("content") or "").strip()
+        if not content:
+            continue
+        role = m.get("role") or "user"
+        lines.append(f"{_ROLE_UPPER.get(role) or role.upper()}: {content}")
+        if role == "user":
+            last_user = content
+
+    return "\n".join(lines), last_user
+
 
-    return f"""
+# Invariant instructions, identical for every request. Kept ahead of the
+# per-request tail so every prompt shares the same prefix, which Gemini's
+# implicit caching can reuse.
+STATIC_PREAMBLE = """
 You are a PROMPT REWRITER for LLM chats.
 
 You will receive:
@@ -96,41 +211,85 @@ You will output STRICT JSON with these keys:
 - "suggested_prompt": the single BEST improved, self-contained FIRST-PERSON prompt the user should send next.
 - "alternatives": ALWAYS an empty array [] (do NOT put any prompts here).
 - "confidence": number between 0 and 1 (your confidence that the suggested_prompt will work well).
+""".strip()
 
-Full conversation:
-{convo}
 
-Last user message (for focus):
-{last_user}
+# Literal pieces of the per-request tail, interleaved with the variable
+# parts by build_variable_tail.
+_PROMPT_PARTS = (
+    "Full conversation:\n",
+    "\n\nLast user message (for focus):\n",
+    "\n\nUser comment (may be empty):\n",
+    "\n\nTask hint (may be empty):\n",
+)
 
-User comment (may be empty):
-{user_comment or "(none)"}
 
-Task hint (may be empty):
-{task_hint or "(none)"}
-""".strip()
+def build_variable_tail(
+    convo: str,
+    last_user: str,
+    user_comment: Optional[str] = None,
+    task_hint: Optional[str] = None,
+) -> str:
+    """The per-request part of the prompt that follows STATIC_PREAMBLE."""
+    return "".join((
+        _PROMPT_PARTS[0], convo,
+        _PROMPT_PARTS[1], last_user,
+        _PROMPT_PARTS[2], user_comment or _NONE,
+        _PROMPT_PARTS[3], task_hint or _NONE,
+    ))
 
 
-# ---------- Helper: call Gemini + JSON parsing ----------
+# ---------- Helper: call Gemini ----------
 
-def call_llm(system: str, user: str) -> str:
-    """Call Gemini with retry logic for rate limits."""
-    prompt = f"System:\n{system}\n\nUser:\n{user}"
+# Upper bound on Gemini requests in flight from this process
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+_gemini_slots = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
 
+
+async def call_llm(system: str, user: str) -> AnalyzeRaw:
+    """
+    Call Gemini with retry logic for rate limits and decode its JSON reply.
+
+    `user` is the variable tail of the prompt; it is sent after the shared
+    STATIC_PREAMBLE.
+    """
     max_retries = 3
     base_delay = 2  # Start with 2 seconds
+    max_output_tokens = MAX_OUTPUT_TOKENS
+    prompt = f"System:\n{system}\n\nUser:\n{STATIC_PREAMBLE}\n\n{user}"
     
     for attempt in range(max_retries):
         try:
-            resp = client.models.generate_content(
-                model=GEMINI_MODEL,
-                contents=prompt,
-                config=genai_types.GenerateContentConfig(
-                    temperature=0.2,
-                    max_output_tokens=8192,
-                ),
+            async with _gemini_slots:
+                stream = await get_client().aio.models.generate_content_stream(
+                    model=GEMINI_MODEL,
+                    contents=prompt,
+                    config=genai_types.GenerateContentConfig(
+                        temperature=TEMPERATURE,
+                        max_output_tokens=max_output_tokens,
+                        thinking_config=_THINKING_CONFIG,
+                        response_mime_type="application/json",
+                        response_schema=RESPONSE_SCHEMA,
+                    ),
+                )
+                # Annotated as AsyncIterator by the SDK, but it is an async
+                # generator, which read_json_stream needs for aclose()
+                data = await read_json_stream(
+                    cast(AsyncGenerator[genai_types.GenerateContentResponse, None], stream)
+                )
+
+            if data is not None:
+                return data
+            if max_output_tokens >= MAX_OUTPUT_TOKENS_RETRY:
+                raise Exception("Gemini response was cut off at the output token limit.")
+
+            # stderr: under the stdio transport stdout carries the JSON-RPC stream
+            print(
+                f"✂️ Response hit the {max_output_tokens}-token cap, retrying with {MAX_OUTPUT_TOKENS_RETRY}...",
+                file=sys.stderr,
             )
-            return (resp.text or "").strip()
+            max_output_tokens = MAX_OUTPUT_TOKENS_RETRY
+            continue
         
         except Exception as e:
             error_str = str(e)
@@ -140,8 +299,11 @@ def call_llm(system: str, user: str) -> str:
                 if attempt < max_retries - 1:
                     # Exponential backoff: 2s, 4s, 8s
                     wait_time = base_delay * (2 ** attempt)
-                    print(f"⏳ Rate limited (attempt {attempt + 1}/{max_retries}). Waiting {wait_time}s...")
-                    time.sleep(wait_time)
+                    print(
+                        f"⏳ Rate limited (attempt {attempt + 1}/{max_retries}). Waiting {wait_time}s...",
+                        file=sys.stderr,
+                    )
+                    await asyncio.sleep(wait_time)
                     continue
                 else:
                     # Last attempt failed
@@ -153,92 +315,239 @@ def call_llm(system: str, user: str) -> str:
                 # Not a rate limit error, raise immediately
                 raise
     
-    return ""
+    # Retries used up on rate limits followed by a truncated reply
+    raise Exception("Gemini did not return a complete answer. Please try again.")
 
 
-def strip_code_fences(text: str) -> str:
-    """Remove ``` or ```json fences if the model wraps the JSON."""
-    t = text.strip()
-    if t.startswith("```"):
-        parts = t.split("```", 2)
-        if len(parts) >= 2:
-            inner = parts[1]
-            if inner.lstrip().startswith("json"):
-                inner = inner.lstrip()[4:].lstrip()
-            return inner.strip()
-    return t
+# Characters that matter when matching braces; everything else is skipped
+# by the regex engine rather than a Python loop
+_JSON_TOKEN_RE = re.compile(r'[{}"\\]')
 
 
-def safe_parse_json(text: str) -> dict:
-    cleaned = strip_code_fences(text)
-    try:
-        return json.loads(cleaned)
-    except Exception:
-        # Last resort: try to find outermost braces
-        start = cleaned.find("{")
-        end = cleaned.rfind("}")
-        if start != -1 and end != -1 and end > start:
-            return json.loads(cleaned[start : end + 1])
-        raise
+class JsonObjectScanner:
+    """
+    Single-pass scanner for the first top-level JSON object in a growing
+    buffer. Tracks string/escape state and brace depth, so braces inside
+    string values don't count, and resumes where it left off on each call.
+    """
 
+    def __init__(self) -> None:
+        self.pos = 0       # scanned up to here
+        self.skip_to = 0   # character after a backslash escape
+        self.start = -1    # index of the opening brace
+        self.depth = 0
+        self.in_string = False
+
+    def scan(self, buf: str) -> Optional[Tuple[int, int]]:
+        """Return the object's (start, end) once its closing brace is seen."""
+        for m in _JSON_TOKEN_RE.finditer(buf, self.pos):
+            i = m.start()
+            if i < self.skip_to:
+                continue
+            ch = m.group()
+
+            if self.in_string:
+                if ch == "\\":
+                    self.skip_to = i + 2
+                elif ch == '"':
+                    self.in_string = False
+            elif self.depth == 0:
+                # Anything before the object (stray text, quotes) is ignored
+                if ch == "{":
+                    self.start = i
+                    self.depth = 1
+            elif ch == '"':
+                self.in_string = True
+            elif ch == "{":
+                self.depth += 1
+            elif ch == "}":
+                self.depth -= 1
+                if self.depth == 0:
+                    self.pos = i + 1
+                    return self.start, i + 1
+
+        self.pos = len(buf)
+        return None
+
+
+async def read_json_stream(
+    stream: AsyncGenerator[genai_types.GenerateContentResponse, None],
+) -> Optional[AnalyzeRaw]:
+    """
+    Read streamed chunks until they form a complete JSON object, then stop.
 
-# ---------- MCP Tool ----------
+    Anything the model would emit after the closing brace (JSON mode can
+    pad with whitespace up to the token cap) is never waited for. Returns
+    None if the reply was cut off at max_output_tokens.
+    """
+    buf = ""
+    finish_reason = None
+    scanner = JsonObjectScanner()
+    async with contextlib.aclosing(stream):
+        async for chunk in stream:
+            buf += chunk.text or ""
+            if chunk.candidates and chunk.candidates[0].finish_reason:
+                finish_reason = chunk.candidates[0].finish_reason
+            span = scanner.scan(buf)
+            if span is not None:
+                return _decode_raw(buf[span[0] : span[1]])
 
-@mcp.tool()
-def analyze_dislike(
-    messages: List[ChatMessage],
-    user_comment: Optional[str] = None,
-    task_hint: Optional[str] = None,
-) -> AnalyzeResult:
+    if finish_reason == genai_types.FinishReason.MAX_TOKENS:
+        return None
+
+    # Stream ended without a decodable object: let the full parse raise
+    return _decode_raw(buf)
+
+
+# ---------- Helper: result cache ----------
+
+# key -> (stored_at, ready-to-send tool result), oldest first
+_result_cache: "OrderedDict[str, Tuple[float, ToolResult]]" = OrderedDict()
+
+
+def cache_key(user_prompt: str) -> str:
+    """Hash the rendered prompt tail together with the generation settings."""
+    digest = hashlib.blake2b(user_prompt.encode(), digest_size=16).hexdigest()
+    return f"{digest}:{GEMINI_MODEL}:{TEMPERATURE}:{MAX_OUTPUT_TOKENS}"
+
+
+def cache_get(key: str) -> Optional[ToolResult]:
+    """Return a fresh cached result, or None on miss/expiry."""
+    entry = _result_cache.get(key)
+    if entry is None:
+        return None
+
+    stored_at, result = entry
+    if time.monotonic() - stored_at > LLM_CACHE_TTL:
+        del _result_cache[key]
+        return None
+
+    _result_cache.move_to_end(key)
+    return result
+
+
+def cache_put(key: str, result: ToolResult) -> None:
+    """Store a result, evicting the least recently used entries."""
+    _result_cache[key] = (time.monotonic(), result)
+    _result_cache.move_to_end(key)
+    while len(_result_cache) > LLM_CACHE_MAX_ENTRIES:
+        _result_cache.popitem(last=False)
+
+
+# ---------- Helper: semantic cache ----------
+
+class SemanticIndex:
     """
-    Analyze a disliked LLM response and suggest a better follow-up prompt.
+    Nearest-neighbour lookup from prompt embeddings to result-cache keys.
+
+    Vectors are unit-normalized into a fixed ring of rows, so a search is one
+    matrix-vector product; with at most LLM_CACHE_MAX_ENTRIES rows that is
+    well under a millisecond and needs no ANN library. The oldest row is
+    overwritten when full. Keys that have since left the result cache simply
+    miss on lookup. numpy is imported on construction, so the default
+    (feature off) configuration never loads it.
     """
 
-    base_system = (
-        "Return ONLY a JSON object with keys: "
-        "summary, root_causes, suggested_prompt, alternatives, confidence."
-    )
-    strict_system = (
-        "STRICT JSON ONLY. Keys: summary, root_causes, suggested_prompt, "
-        "alternatives, confidence. No extra text."
-    )
-
-    user_prompt = build_user_prompt(messages, user_comment, task_hint)
+    def __init__(self, capacity: int, dim: int) -> None:
+        import numpy as np
+
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.keys: List[Optional[str]] = [None] * capacity
+        self.rows: Dict[str, int] = {}
+        self.next_row = 0
+        self.size = 0
+
+    def search(self, vector: "np.ndarray") -> Optional[str]:
+        """Return the key closest to `vector` if within SEMANTIC_CACHE_MAX_DISTANCE."""
+        if self.size == 0:
+            return None
+        sims = self.vectors[: self.size] @ vector
+        best = int(sims.argmax())
+        if 1.0 - float(sims[best]) < SEMANTIC_CACHE_MAX_DISTANCE:
+            return self.keys[best]
+        return None
+
+    def add(self, key: str, vector: "np.ndarray") -> None:
+        if key in self.rows:
+            return
+
+        row = self.next_row
+        old_key = self.keys[row]
+        if old_key is not None:
+            del self.rows[old_key]
+
+        self.vectors[row] = vector
+        self.keys[row] = key
+        self.rows[key] = row
+        self.next_row = (row + 1) % len(self.keys)
+        self.size = max(self.size, row + 1)
+
+
+_semantic_index = (
+    SemanticIndex(LLM_CACHE_MAX_ENTRIES, SEMANTIC_CACHE_DIM)
+    if ENABLE_LLM_CACHE and ENABLE_SEMANTIC_CACHE
+    else None
+)
+
+
+async def embed_prompt(user_prompt: str) -> Optional["np.ndarray"]:
+    """
+    Unit-length embedding of a prompt tail, or None if the call fails (the
+    request then just skips the semantic lookup). Only the tail is embedded:
+    the shared preamble would make every prompt look alike.
+    """
+    import numpy as np
 
-    # First attempt
-    raw = call_llm(base_system, user_prompt)
+    client = get_client()
     try:
-        data = safe_parse_json(raw)
-    except Exception:
-        # Add delay before retry to avoid hitting rate limit again
-        print("⏳ Waiting 3 seconds before retry...")
-        time.sleep(3)
-        
-        # Retry with stricter instructions
-        raw2 = call_llm(strict_system, user_prompt)
-        data = safe_parse_json(raw2)
+        async with _gemini_slots:
+            resp = await client.aio.models.embed_content(
+                model=GEMINI_EMBEDDING_MODEL,
+                contents=user_prompt,
+                config=genai_types.EmbedContentConfig(
+                    task_type="SEMANTIC_SIMILARITY",
+                    output_dimensionality=SEMANTIC_CACHE_DIM,
+                ),
+            )
+    except Exception as e:
+        print(f"⚠️ Embedding failed, skipping semantic cache: {e}", file=sys.stderr)
+        return None
 
-    # Build result with sensible defaults
-    summary = data.get("summary", "").strip()
-    suggested_prompt = data.get("suggested_prompt", "").strip()
-    root_causes = data.get("root_causes") or []
-    # Ignore whatever the model put in `alternatives` – we want a single best prompt only
-    confidence_raw = data.get("confidence", 0.8)
+    values = resp.embeddings[0].values if resp.embeddings else None
+    if not values:
+        return None
 
-    try:
-        confidence = float(confidence_raw)
-    except Exception:
-        confidence = 0.8
+    # GEMINI_EMBEDDING_MODEL is configurable; a model that ignores
+    # output_dimensionality must not reach the fixed-width index
+    vector = np.asarray(values, dtype=np.float32)
+    if vector.shape != (SEMANTIC_CACHE_DIM,):
+        print(
+            f"⚠️ {GEMINI_EMBEDDING_MODEL} returned {vector.shape[0]} dims, expected "
+            f"{SEMANTIC_CACHE_DIM}; skipping semantic cache",
+            file=sys.stderr,
+        )
+        return None
+
+    norm = float(np.linalg.norm(vector))
+    return vector / norm if norm else None
+
+
+# ---------- Analysis ----------
+
+async def analyze_prompt(user_prompt: str) -> AnalyzeResult:
+    """Ask Gemini about a rendered prompt tail and normalize its answer."""
+
+    # response_schema makes Gemini emit valid JSON, so no fence stripping
+    # or strict-prompt retry is needed
+    data = await call_llm(SYSTEM_PROMPT, user_prompt)
 
-    if confidence < 0:
-        confidence = 0.0
-    if confidence > 1:
-        confidence = 1.0
+    # Defaults and type coercion are handled by AnalyzeRaw; only clamp here
+    confidence = min(max(data.confidence, 0.0), 1.0)
 
     result: AnalyzeResult = {
-        "summary": summary,
-        "root_causes": list(root_causes),
-        "suggested_prompt": suggested_prompt,
+        "summary": data.summary.strip(),
+        "root_causes": data.root_causes,
+        "suggested_prompt": data.suggested_prompt.strip(),
         # 🔒 Force alternatives to always be an empty list
         "alternatives": [],
         "confidence": confidence,
@@ -246,6 +555,92 @@ def analyze_dislike(
     return result
 
 
+def build_tool_result(result: AnalyzeResult) -> ToolResult:
+    """
+    Wrap a result with its JSON text already encoded, so FastMCP sends it
+    as-is instead of serializing the dict again (and cache hits reuse it).
+    """
+    return ToolResult(
+        content=[TextContent(type="text", text=_encode_json(result).decode())],
+        structured_content=result,
+    )
+
+
+# Returned without calling Gemini when there is no conversation to analyze
+_EMPTY_RESULT = build_tool_result({
+    "summary": "There was no conversation to analyze, so there is no failed answer to diagnose.",
+    "root_causes": ["The recent conversation was empty or every message in it was blank."],
+    "suggested_prompt": (
+        "Help me refine my question. Ask me what I'm trying to achieve, "
+        "then suggest a clear, specific way for me to phrase it."
+    ),
+    "alternatives": [],
+    "confidence": 0.2,
+})
+
+
+# Requests whose Gemini call is still running, by cache key. Concurrent
+# identical requests await the same task instead of issuing their own call.
+_inflight: Dict[str, "asyncio.Task[ToolResult]"] = {}
+
+
+async def resolve_prompt(key: str, user_prompt: str) -> ToolResult:
+    """Build and cache the tool result for a prompt tail; runs once per in-flight key."""
+    embedding = None
+    if _semantic_index is not None:
+        embedding = await embed_prompt(user_prompt)
+        if embedding is not None:
+            similar_key = _semantic_index.search(embedding)
+            similar = cache_get(similar_key) if similar_key else None
+            if similar is not None:
+                # Keep it under this exact key too, so repeats skip the embedding
+                cache_put(key, similar)
+                return similar
+
+    result = build_tool_result(await analyze_prompt(user_prompt))
+    if ENABLE_LLM_CACHE:
+        cache_put(key, result)
+    if _semantic_index is not None and embedding is not None:
+        _semantic_index.add(key, embedding)
+    return result
+
+
+# ---------- MCP Tool ----------
+
+# The tool returns a prebuilt ToolResult, so its schema is given explicitly
+@mcp.tool(output_schema=TypeAdapter(AnalyzeResult).json_schema())
+async def analyze_dislike(
+    messages: List[ChatMessage],
+    user_comment: Optional[str] = None,
+    task_hint: Optional[str] = None,
+) -> ToolResult:
+    """
+    Analyze a disliked LLM response and suggest a better follow-up prompt.
+    """
+
+    convo, last_user = render_conversation(messages)
+    # Nothing left in the rendered window (blank messages are dropped)
+    if not convo:
+        return _EMPTY_RESULT
+
+    user_prompt = build_variable_tail(convo, last_user, user_comment, task_hint)
+
+    key = cache_key(user_prompt)
+    if ENABLE_LLM_CACHE:
+        cached = cache_get(key)
+        if cached is not None:
+            return cached
+
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(resolve_prompt(key, user_prompt))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+
+    # Shield so one caller disconnecting doesn't cancel the others' call
+    return await asyncio.shield(task)
+
+
 
 # ---------- Local dev entrypoint (FastMCP Cloud ignores this) ----------
 